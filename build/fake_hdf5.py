@@ -17,19 +17,25 @@ Use
     (Required) [filebase] - Path to .phot file, with or without .phot extension.
     (Optional) [--to_hdf] - Whether to write the dataframe to an HDF5 
     file. Default is True.
-    (Optional) [--full] - Whether to use the full set of columns (photometry of 
-    individual exposures). Default is False.
+    (Optional) [fake_full] - Config parameter, whether to use the full set of
+    columns (photometry of individual exposures). Default is "T".
 """
 
 import wpipe as wp
-import dask.dataframe as dd
+import functools
 import numpy as np
 import os
 import pandas as pd
+import tables
 import traceback
 from astropy.io import fits
 from astropy.wcs import WCS
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+try:
+    from numba import njit, prange
+except ImportError: # numba is optional, stflags falls back to numpy
+    njit = None
 
 
 
@@ -73,44 +79,106 @@ colname_mappings = {
     'Photometry quality flag,'           : 'flag',
 }
 
-def cull_photometry(df, filter_detectors, my_config, snrcut=4.0):
-                    #cut_params={'irsharp'   : 0.15, 'ircrowd'   : 2.25,
-                    #            'uvissharp' : 0.15, 'uviscrowd' : 1.30,
-                    #            'wfcsharp'  : 0.20, 'wfccrowd'  : 2.25}):
-    """Add 'ST' and 'GST' flag columns based on stellar parameters.
+# dolphot only prints 4-5 significant figures, so photometry columns are
+# read as float32 and integer columns are narrowed to match
+float32_suffixes = tuple('_' + v for v in colname_mappings.values() if v != 'flag')
+int_columns = {'ext': np.int32, 'chip': np.int32, 'objtype_gl': np.int8}
+
+# let blosc compress HDF5 chunks on every core
+tables.set_blosc_max_threads(os.cpu_count() or 1)
+
+# bit 2 of a packed '<filter>_stflag' column marks a filter whose cuts could
+# not be computed, so it can be told apart from a filter with no ST stars
+stflag_not_computed = 4
+
+def is_st(flags):
+    """Return ST membership from a packed '<filter>_stflag' column (bit 0)."""
+    return (flags & 1) != 0
+
+def is_gst(flags):
+    """Return GST membership from a packed '<filter>_stflag' column (bit 1)."""
+    return (flags & 2) != 0
+
+def unpack_stflags(df):
+    """Add boolean '<filter>_st' and '<filter>_gst' columns for every packed
+    '<filter>_stflag' column in df. Filters whose cuts were not computed get
+    NaN columns instead."""
+    for col in df.columns[df.columns.str.endswith('_stflag')]:
+        fl = col[:-len('_stflag')]
+        if ((df[col] & stflag_not_computed) != 0).any():
+            df[fl + '_st'] = np.nan
+            df[fl + '_gst'] = np.nan
+        else:
+            df[fl + '_st'] = is_st(df[col])
+            df[fl + '_gst'] = is_gst(df[col])
+    return df
 
-    TODO:
-        - Allow for modification by command line
-        - Generalize to more parameters?
-        - Allow to interact with perl...?
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _stflag_kernel(snr, sh, cr, snrcut, sharp_th, crowd_th, out):
+        for i in prange(snr.shape[0]):
+            for j in range(snr.shape[1]):
+                flag = 0
+                if snr[i, j] > snrcut and sh[i, j] * sh[i, j] < sharp_th[j]:
+                    flag = 1
+                    if cr[i, j] < crowd_th[j]:
+                        flag = 3
+                out[i, j] = flag
+
+def stflags(snr, sh, cr, snrcut, sharp_th, crowd_th):
+    """Compute packed ST/GST flags for several filters at once.
+
+    Inputs
+    ------
+    snr, sh, cr : ndarray
+        (N, F) arrays of signal-to-noise, sharpness and crowding, one
+        column per filter
+    snrcut : scalar
+        minimum signal-to-noise ratio for ST
+    sharp_th, crowd_th : ndarray
+        length F arrays of per-filter sharpness and crowding thresholds
+
+    Returns
+    -------
+    out : ndarray
+        (N, F) uint8 array with bit 0 set for ST and bit 1 for GST
+    """
+    if njit is not None:
+        out = np.empty(snr.shape, dtype=np.uint8)
+        _stflag_kernel(snr, sh, cr, snrcut, sharp_th, crowd_th, out)
+        return out
+    st = (snr > snrcut) & (sh * sh < sharp_th)
+    gst = st & (cr < crowd_th)
+    return st.astype(np.uint8) | (gst.astype(np.uint8) << 1)
+
+def get_cut_params(filter_detectors, my_config):
+    """Resolve the ST/GST thresholds for every filter from the configuration,
+    filling in defaults for any that are missing.
 
     Inputs
     ------
-    df : DataFrame
-        table read in by read_dolphot
     filter_detectors : list of strings
-        list of detectors + filters in 'detector-filter' format,
-        ex. 'WFC-F814W'
-    snrcut : scalar, optional
-        minimum signal-to-noise ratio for a star to be flagged as 'ST'
-        default: 4.0
-    cut_params : dict
-        dictionary of parameters to cut on, with keys in '<detector><quantity>'
-        format, and scalar values.
+        list of detectors + filters in 'detector_filter' format,
+        ex. 'ACS_F814W'
+    my_config : pipeline configuration for this reduction
 
     Returns
     -------
-    df : DataFrame
-        table read in by read_dolphot, with ST and GST columns added
-        (name format: '<filter>_(g)st')
+    snrcut : float
+        minimum signal-to-noise ratio for a star to be flagged as 'ST'
+    cut_params : dict
+        (sharp, crowd) thresholds keyed by lowercase filter name; filters
+        whose thresholds could not be resolved are left out
     """
     try:
         snrcut = my_config.parameters["snrcut"]
     except:
         snrcut = 4.0
         print("No parameter for snrcut, setting to 4")
+    cut_params = {}
     for filt in filter_detectors:
-        d, f = filt.lower().split('_') # split into detector + filter
+        fl = filt.lower()
+        d, f = fl.split('_') # split into detector + filter
         if d=='wfc3' and 'f1' in f:
            d = 'ir'
            try:
@@ -160,23 +228,72 @@ def cull_photometry(df, filter_detectors, my_config, snrcut=4.0):
                my_config.parameters["nircam_crowd"] = 0.5 
         try:
             print('Making ST and GST cuts for {}'.format(filt))
-            # make boolean arrays for each set of culling parameters
-            snr_condition = df.loc[:,'{}_snr'.format(filt.lower())] > snrcut
-            #sharp_condition = df.loc[:,'{}_sharp'.format(f)]**2 < cut_params['{}sharp'.format(d)]
-            #crowd_condition = df.loc[:,'{}_crowd'.format(f)] < cut_params['{}crowd'.format(d)]
-            sharp_condition = df.loc[:,'{}_sharp'.format(filt.lower())]**2 < my_config.parameters['{}_sharp'.format(d)]
-            crowd_condition = df.loc[:,'{}_crowd'.format(filt.lower())] < my_config.parameters['{}_crowd'.format(d)]
-            # add st and gst columns
-            df.loc[:,'{}_st'.format(filt.lower())] = (snr_condition & sharp_condition).astype(bool)
-            df.loc[:,'{}_gst'.format(filt.lower())] = (df['{}_st'.format(filt.lower())] & crowd_condition).astype(bool)
-            print('Found {} out of {} stars meeting ST criteria for {}'.format(
-                df.loc[:,'{}_st'.format(filt.lower())].sum(), df.shape[0], filt.lower()))
-            print('Found {} out of {} stars meeting GST criteria for {}'.format(
-                df.loc[:,'{}_gst'.format(filt.lower())].sum(), df.shape[0], filt.lower()))
+            cut_params[fl] = (float(my_config.parameters[f'{d}_sharp']),
+                              float(my_config.parameters[f'{d}_crowd']))
         except Exception:
-            df.loc[:,'{}_st'.format(filt.lower())] = np.nan
-            df.loc[:,'{}_gst'.format(filt.lower())] = np.nan
-            print('Could not perform culling for {}.\n{}'.format(filt.lower(), traceback.format_exc()))
+            print('Could not perform culling for {}.\n{}'.format(fl, traceback.format_exc()))
+    return float(snrcut), cut_params
+
+def cull_photometry(df, filter_detectors, my_config, snrcut=4.0, cut_params=None):
+    """Add a packed 'ST'/'GST' flag column based on stellar parameters.
+
+    TODO:
+        - Allow for modification by command line
+        - Generalize to more parameters?
+        - Allow to interact with perl...?
+
+    Inputs
+    ------
+    df : DataFrame
+        table read in by read_dolphot
+    filter_detectors : list of strings
+        list of detectors + filters in 'detector-filter' format,
+        ex. 'WFC-F814W'
+    snrcut : scalar, optional
+        minimum signal-to-noise ratio for a star to be flagged as 'ST'
+        default: 4.0
+    cut_params : dict, optional
+        (sharp, crowd) thresholds keyed by lowercase filter name, from
+        `get_cut_params`. Looked up from my_config (together with snrcut)
+        when not given.
+
+    Returns
+    -------
+    df : DataFrame
+        table read in by read_dolphot, with a uint8 flag column added per
+        filter (name format: '<filter>_stflag'); bit 0 is set for ST stars
+        and bit 1 for GST stars, see `is_st` and `is_gst`; filters that
+        could not be culled have only bit 2 set, see `unpack_stflags`
+    """
+    if cut_params is None:
+        snrcut, cut_params = get_cut_params(filter_detectors, my_config)
+    culled = {}
+    for filt in filter_detectors:
+        fl = filt.lower()
+        if fl not in cut_params:
+            continue
+        try:
+            # gather columns and thresholds, cuts are made for all filters at once
+            culled[f'{fl}_stflag'] = (df[f'{fl}_snr'].to_numpy(np.float32),
+                                      df[f'{fl}_sharp'].to_numpy(np.float32),
+                                      df[f'{fl}_crowd'].to_numpy(np.float32),
+                                      *cut_params[fl])
+        except KeyError:
+            # missing columns, the filter is flagged as not computed below
+            continue
+    if culled:
+        snr, sh, cr, sharp_th, crowd_th = zip(*culled.values())
+        flags = stflags(np.column_stack(snr), np.column_stack(sh),
+                        np.column_stack(cr), np.float32(snrcut),
+                        np.array(sharp_th, dtype=np.float32),
+                        np.array(crowd_th, dtype=np.float32))
+        culled = dict(zip(culled, flags.T))
+    for filt in filter_detectors:
+        stflag_col = f'{filt.lower()}_stflag'
+        if stflag_col not in culled:
+            df[stflag_col] = np.full(df.shape[0], stflag_not_computed, dtype=np.uint8)
+        else:
+            df[stflag_col] = np.ascontiguousarray(culled[stflag_col])
     return df
 
 def make_header_table(my_config, fitsdir, search_string='*.chip?.fits'):
@@ -197,7 +314,6 @@ def make_header_table(my_config, fitsdir, search_string='*.chip?.fits'):
     df : DataFrame
         A table of header key-value pairs indexed by image name.
     """
-    keys = []
     headers = {}
     fitslist = wp.DataProduct.select(
         config_id=my_config.config_id, 
@@ -207,44 +323,35 @@ def make_header_table(my_config, fitsdir, search_string='*.chip?.fits'):
     if len(fitslist) == 0: # this shouldn't happen
         print('No fits files found in {}!'.format(fitsdir))
         return pd.DataFrame()
-    # get headers from each image
-    for fitsfile in fitslist:
-        fitsname = fitsfile.filename # filename without preceding path
-        fitspath = fitsfile.config.procpath + "/" + fitsname
-        head = fits.getheader(fitspath, ignore_missing_end=True)
+    # get headers from each image, reading the files in parallel
+    paths = [(f.filename, f.config.procpath + "/" + f.filename) for f in fitslist]
+    with ThreadPoolExecutor(max_workers=min(32, len(paths))) as ex:
+        results = list(ex.map(
+            lambda p: (p[0], fits.getheader(p[1], ignore_missing_end=True)), paths))
+    for fitsname, head in results:
         headers.update({fitsname:head})
-        keys += [k for k in head.keys()]
-    unique_keys = np.unique(keys).tolist()
+    # construct dataframe in one pass, one row per image
+    df = pd.DataFrame.from_dict(
+        {fitsname.split('.fits')[0]: dict(head.items())
+         for fitsname, head in headers.items()}, orient='index')
     remove_keys = ['COMMENT', 'HISTORY', '']
-    for key in remove_keys:
-        if key in unique_keys:
-            unique_keys.remove(key)
-    # construct dataframe
-    df = pd.DataFrame(columns=unique_keys)
-    for fitsname, head in headers.items():
-        row = pd.Series(dict(head.items()))
-        df.loc[fitsname.split('.fits')[0]] = row.T
+    df.drop(columns=[k for k in remove_keys if k in df.columns], inplace=True)
+    df.sort_index(axis=1, inplace=True)
     # I do not know why dask is so bad at mixed types
     # but here is my hacky solution
     try:
         df = df.infer_objects()
     except Exception:
         print("Could not infer objects")
+    # coerce leftover object columns to numbers where possible, string
+    # keywords stay strings even when they look numeric (e.g. LINENUM)
+    for c in df.select_dtypes(['object']).columns:
+        if pd.api.types.infer_dtype(df[c], skipna=True) != 'string':
+            df[c] = pd.to_numeric(df[c], errors='ignore')
+    # anything still mixed is written out as strings
     df_obj = df.select_dtypes(['object'])
-    # iterate over columns and force types
-    for c in df_obj:
-        dtype = pd.api.types.infer_dtype(df[c], skipna=True)
-        if dtype == 'string':
-            df.loc[:,c] = df.loc[:,c].astype(str)
-        elif dtype in ['float','mixed-integer-float']:
-            df.loc[:,c] = df.loc[:,c].astype(float)
-        elif dtype == 'integer':
-            df.loc[:,c] = df.loc[:,c].astype(int)
-        elif dtype == 'boolean':
-            df.loc[:,c] = df.loc[:,c].astype(bool)
-        else:
-            print('Unrecognized datatype "{}" for column {}; coercing to string'.format(dtype, c))
-            df.loc[:,c] = df.loc[:,c].astype(str)
+    if len(df_obj.columns) > 0:
+        df[df_obj.columns] = df_obj.astype(str)
     return df
 
 def name_columns(param_file,colfile):
@@ -265,23 +372,27 @@ def name_columns(param_file,colfile):
     filters : list
         List of filters included in output
     """
-    df = pd.DataFrame(data=np.loadtxt(colfile, delimiter='. ', dtype=str),
-                          columns=['index','desc']).drop('index', axis=1)
+    df = pd.read_csv(colfile, sep=r'\.\s+', header=None, names=['index','desc'],
+                     dtype=str, engine='python').drop('index', axis=1)
     df = df.assign(colnames='')
     # set inputcolumns
     df.loc[:3,'colnames']=['extin','chipin','xin','yin']
-    params = np.loadtxt(param_file, delimiter='none', dtype=str)
+    params = pd.read_csv(param_file, sep='=', header=None, names=['imgnum','imname'],
+                         dtype=str, comment='#', skipinitialspace=True, engine='c')
     colcount = 3
-    allfilts = 'xxx'
-    for i in range(len(params)):
-        imgnum,imname = params[i].split('=')
+    seen_filts = set()
+    # look up every proc dataproduct for this config once instead of per image
+    dp_map = {dp.filename: dp
+              for dp in wp.DataProduct.select(dpowner_id=my_config.config_id,
+                                              group="proc")}
+    for i, (imgnum, imname) in enumerate(zip(params.imgnum, params.imname)):
         if ("chip" in imname and "img" in imgnum):
-           imdp = wp.DataProduct.select(dpowner_id=my_config.config_id, filename=imname+".fits") 
+           imdp = dp_map[imname+".fits"]
            imfilt = imdp.options["filter"]
-           if imfilt in allfits:
+           if imfilt in seen_filts:
                colname = [imfilt+str(i)+"_counts_in",imfilt+str(i)+"_mag_in"]
            else:
-               allfilts = allfilts+"imfilt"
+               seen_filts.add(imfilt)
                colname = [imfilt+"_counts_in",imfilt+"_mag_in"]
            colcount += 1
            df.loc[colcount:colcount+1,'colnames'] = colname
@@ -303,11 +414,42 @@ def name_columns(param_file,colfile):
         filters_all.append(filters.values)
         df.loc[indices_total,'colnames'] = filters.str.lower() + '_' + v.lower()
         df.loc[indices_indiv,'colnames'] = imgnames + '_' + v.lower()
-    filters_final = np.unique(np.array(filters_all).ravel())
+    # dedupe keeping the order filters appear in the columns file
+    filters_final = pd.unique(np.concatenate(filters_all)) if filters_all else np.array([])
     print('Filters found: {}'.format(filters_final))
     return df, filters_final
 
-def add_wcs(df, photfile, my_config):
+@functools.lru_cache(maxsize=8)
+def _get_wcs(path):
+    """Build the WCS of a reference image once per path from its header."""
+    return WCS(fits.getheader(path, ignore_missing_end=True))
+
+def get_astrometric_reference(my_config):
+    """Find the drizzled file that dolphot uses for astrometry
+
+    Inputs
+    ------
+    my_config : pipeline configuration for this reduction
+
+    Returns
+    -------
+    drzfile : string or None
+        filename of the reference image, None if there is not exactly one
+    """
+    #drzfiles = list(Path(photfile).parent.glob('*_dr?.chip1.fits'))
+    drzfiles = wp.DataProduct.select(config_id=my_config.config_id, subtype="reference_prepped") 
+    # neither of these should happen but just in case
+    if len(drzfiles) == 0:
+        print('No drizzled files found; skipping RA and Dec')
+        return None
+    if len(drzfiles) > 1:
+        print('Multiple drizzled files found: {}'.format(drzfiles))
+        return None
+    drzfile = str(drzfiles[0].filename)
+    print('Using {} as astrometric reference'.format(drzfile))
+    return drzfile
+
+def add_wcs(df, photfile, my_config, drzfile=None):
     """Converts x and y columns to world coordinates using drizzled file
     that dolphot uses for astrometry
 
@@ -317,6 +459,9 @@ def add_wcs(df, photfile, my_config):
         path to raw dolphot output
     df : DataFrame
         photometry table read in by read_dolphot
+    drzfile : string, optional
+        reference image from `get_astrometric_reference`, looked up when
+        not given
 
     Returns
     -------
@@ -324,23 +469,19 @@ def add_wcs(df, photfile, my_config):
         A table of column descriptions and their corresponding names,
         with new 'ra' and 'dec' columns added.
     """
-    #drzfiles = list(Path(photfile).parent.glob('*_dr?.chip1.fits'))
-    drzfiles = wp.DataProduct.select(config_id=my_config.config_id, subtype="reference_prepped") 
-    # neither of these should happen but just in case
-    if len(drzfiles) == 0:
-        print('No drizzled files found; skipping RA and Dec')
-    elif len(drzfiles) > 1:
-        print('Multiple drizzled files found: {}'.format(drzfiles))
-    else:
-        drzfile = str(drzfiles[0].filename)
-        print('Using {} as astrometric reference'.format(drzfile))
-        ra, dec = WCS(drzfile).all_pix2world(df.x.values, df.y.values, 0)
-        df.insert(4, 'ra', ra)
-        df.insert(5, 'dec', dec)
+    if drzfile is None:
+        drzfile = get_astrometric_reference(my_config)
+        if drzfile is None:
+            return df
+    x = np.ascontiguousarray(df['x'].to_numpy(), dtype=np.float64)
+    y = np.ascontiguousarray(df['y'].to_numpy(), dtype=np.float64)
+    ra, dec = _get_wcs(drzfile).all_pix2world(x, y, 0, ra_dec_order=True)
+    df.insert(4, 'ra', ra)
+    df.insert(5, 'dec', dec)
     return df
 
 
-def read_dolphot_fake(my_config, fakefile, columns_df, filters):
+def read_dolphot_fake(my_config, fakefile, columns_df, filters, full=True):
     """Reads in raw dolphot output (.phot.fake file) to a DataFrame with named
     columns, and optionally writes it to a HDF5 file.
 
@@ -358,8 +499,9 @@ def read_dolphot_fake(my_config, fakefile, columns_df, filters):
         in the function definition, but defaults to True when this script
         is called from the command line.
     full : bool, optional
-        Whether to include full photometry output in DataFrame. Defaults 
-        to False.
+        Whether to write the single-frame photometry tables too, and name
+        the output '_full.hdf5'. Defaults to True, set from the
+        'fake_full' parameter when this script is run by the pipeline.
 
     Returns
     -------
@@ -370,43 +512,100 @@ def read_dolphot_fake(my_config, fakefile, columns_df, filters):
     -------
         HDF5 file containing photometry table
     """
-    #if not full:
-    #    # cut individual chip columns before reading in .phot file
-    #    columns_df = columns_df[columns_df.colnames.str.find('.chip') == -1]
+    if not full:
+        # cut individual chip columns before reading in .phot file
+        columns_df = columns_df[~columns_df.colnames.str.contains(r'\.chip')]
     colnames = columns_df.colnames
     usecols = columns_df.index
-    # read in dolphot output
-    df = dd.read_csv(fakefile, delim_whitespace=True, header=None,
-                     usecols=usecols, names=colnames,
-                     na_values=99.999).compute()
+    # type every column up front so no chunk has its dtype inferred on its own
+    column_types = {}
+    for c in colnames[usecols]:
+        if c in int_columns:
+            column_types[c] = int_columns[c]
+        elif c.endswith('_flag'):
+            column_types[c] = np.int32
+        elif c.endswith(float32_suffixes):
+            column_types[c] = np.float32
+        else:
+            column_types[c] = np.float64
     #if to_hdf:
     outfile = fakefile + '.hdf5'
     print('Reading in header information from individual images')
     fitsdir = Path(fakefile).parent
     header_df = make_header_table(my_config, fitsdir)
     header_df.to_hdf(outfile, key='fitsinfo', mode='w', format='table',
-                     complevel=9, complib='zlib')
+                     complevel=5, complib='blosc:zstd')
     # lambda function to construct detector-filter pairs
     lamfunc = lambda x: '-'.join(x[~(x.str.startswith('CLEAR')|x.str.startswith('nan'))])
     #filter_detectors = header_df.filter(regex='(DETECTOR)|(FILTER)').astype(str).apply(lamfunc, axis=1).unique()
     #cut_params = {'irsharp'   : 0.15, 'ircrowd'   : my, 'uvissharp' : 0.15, 'uviscrowd' : 1.30, 'wfcsharp'  : 0.20, 'wfccrowd'  : 2.25}
-    print('Writing ASTs to {}'.format(outfile))
-    #df0 = df[colnames[colnames.str.find(r'.chip') == -1]]
-    df0 = df[colnames[colnames.str.find(r'\ (') == -1]]
-    #print("columns are:")
-    #print(df0.columns.tolist())  
-    #df0 = cull_photometry(df0, filter_detectors,my_config)
-    df0 = cull_photometry(df0, filters,my_config)
     my_config.parameters["det_filters"] = ','.join(filters)
-    df0 = add_wcs(df0, photfile, my_config)
-    df0.to_hdf(outfile, key='data', mode='a', format='table', 
-               complevel=9, complib='zlib')
-    outfile_full = outfile.replace('.hdf5','_full.hdf5')
-    os.rename(outfile, outfile_full)
-    for f in filters:
-        print('Writing single-frame photometry table for filter {}'.format(f))
-        df.filter(regex='_{}_'.format(f)).to_hdf(outfile_full, key=f, 
-                      mode='a', format='table', complevel=9, complib='zlib')
+    # stream dolphot output through the C tokenizer one chunk at a time, so
+    # only a single chunk is ever held in memory; fields are separated by
+    # runs of whitespace, as in phot_hdf5
+    chunksize = 500000
+    reader = pd.read_csv(fakefile, sep=r'\s+', header=None, engine='c',
+                         usecols=list(usecols), names=list(colnames),
+                         dtype=column_types, na_values=[99.999],
+                         chunksize=chunksize)
+    # estimate the total row count from the first line so the table chunks
+    # are sized for the whole file up front
+    with open(fakefile) as fh:
+        linelen = len(fh.readline()) or 1
+    expectedrows = max(1, os.path.getsize(fakefile) // linelen)
+    print('Writing ASTs to {}'.format(outfile))
+    if full:
+        print('Writing single-frame photometry tables for filters {}'.format(filters))
+    # resolve the cuts and the astrometric reference once for the whole file
+    snrcut, cut_params = get_cut_params(filters, my_config)
+    drzfile = get_astrometric_reference(my_config)
+    fls = [f.lower() for f in filters]
+    n_st = dict.fromkeys(fls, 0)
+    n_gst = dict.fromkeys(fls, 0)
+    not_computed = set()
+    ntotal = 0
+    cols_by_filter = None
+    with reader, pd.HDFStore(outfile, mode='a', complevel=5,
+                             complib='blosc:zstd') as store:
+        for df in reader:
+            if cols_by_filter is None:
+                # boolean column masks for every filter, computed once
+                cols_arr = df.columns.to_numpy().astype(str)
+                cols_by_filter = {f: cols_arr[np.char.find(cols_arr, '_{}_'.format(f)) >= 0]
+                                  for f in filters}
+            #df0 = df[colnames[colnames.str.find(r'.chip') == -1]]
+            df0 = df[colnames[colnames.str.find(r'\ (') == -1]]
+            #df0 = cull_photometry(df0, filter_detectors,my_config)
+            df0 = cull_photometry(df0, filters, my_config, snrcut, cut_params)
+            if drzfile is not None:
+                df0 = add_wcs(df0, fakefile, my_config, drzfile)
+            # tally ST/GST over the whole file, reported once at the end
+            ntotal += df0.shape[0]
+            for fl in fls:
+                flags = df0[f'{fl}_stflag']
+                if ((flags & stflag_not_computed) != 0).any():
+                    not_computed.add(fl)
+                n_st[fl] += int(is_st(flags).sum())
+                n_gst[fl] += int(is_gst(flags).sum())
+            # skip building a PyTables index on the row labels, nothing queries it
+            store.append('data', df0, format='table', index=False,
+                         expectedrows=expectedrows)
+            if full:
+                for f in filters:
+                    store.append(f, df[cols_by_filter[f]], format='table',
+                                 index=False, expectedrows=expectedrows)
+    for fl in fls:
+        if fl in not_computed:
+            print('Could not perform culling for {}'.format(fl))
+            continue
+        print('Found {} out of {} stars meeting ST criteria for {}'.format(
+            n_st[fl], ntotal, fl))
+        print('Found {} out of {} stars meeting GST criteria for {}'.format(
+            n_gst[fl], ntotal, fl))
+    if full:
+        # only files holding the single-frame tables are named _full
+        outfile_full = outfile.replace('.hdf5','_full.hdf5')
+        os.rename(outfile, outfile_full)
     print('Finished writing HDF5 file')
 
 if __name__ == '__main__':
@@ -438,15 +637,19 @@ if __name__ == '__main__':
     fakefile = my_config.procpath+'/'+this_dp.filename #if args.filebase.endswith('.phot') else args.filebase + '.phot'
     colfile = my_config.parameters['colfile']
     param_file = my_config.parameters['param_file']
-    my_job.logprint('Photometry file: {}'.format(photfile))
+    my_job.logprint('Photometry file: {}'.format(fakefile))
     my_job.logprint('Columns file: {}'.format(colfile))
     columns_df, filters = name_columns(param_file,colfile)
     print("columns_df is ",columns_df)
     
     import time
     t0 = time.time()
-    df = read_dolphot(my_config, fakefile, columns_df, filters)
-    outfile = this_dp.filename + '_full.hdf5'
+    try:
+        full = my_config.parameters["fake_full"] == 'T'
+    except Exception:
+        full = True
+    df = read_dolphot_fake(my_config, fakefile, columns_df, filters, full=full)
+    outfile = this_dp.filename + ('_full.hdf5' if full else '.hdf5')
     hd5_dp = wp.DataProduct(my_config, filename=outfile, 
                               group="proc", data_type="hdf5 file", subtype="catalog")     
     t1 = time.time()
@@ -464,7 +667,6 @@ if __name__ == '__main__':
             options={"dp_id": hd5_dp.dp_id}
             )  # next event
             next_event.fire()
-            time.sleep(150)
  
     else:
         next_event = my_job.child_event(
@@ -482,5 +684,4 @@ if __name__ == '__main__':
         options={"target_id": my_target.target_id}
         )  # next event
         next_event.fire()
-        time.sleep(150)
 
@@ -31,6 +31,7 @@ import argparse
 from astropy.wcs import WCS
 from pathlib import Path
 import time
+from fake_hdf5 import unpack_stflags
 
 
 def register(task):
@@ -164,6 +165,8 @@ if __name__ == "__main__":
     #except:
     import pandas as pd
     df = pd.read_hdf(photfile, key='data')
+    # fakestar tables pack ST/GST into '<filter>_stflag'
+    df = unpack_stflags(df)
     ds = vaex.from_pandas(df)
     #filters = my_config.parameters["filters"].split(',')
     filters = my_config.parameters["det_filters"].split(',')
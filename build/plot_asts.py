@@ -31,6 +31,7 @@ import argparse
 from astropy.wcs import WCS
 from pathlib import Path
 import time
+from fake_hdf5 import is_gst
 
 
 def register(task):
@@ -102,7 +103,8 @@ def make_resid_plot(my_job,ds, path, targname, filter, n_err=12,
         raise ValueError("No input column found")
     xlab = '{}'.format(filter.upper())+" IN"
     ylab = "Out - In" 
-    gst_criteria = ds['{}_gst'.format(filter)] 
+    # fakestar tables pack ST/GST into '<filter>_stflag'
+    gst_criteria = is_gst(ds['{}_stflag'.format(filter)])
     name = path + "/" + targname + "_" + filter + "_" + "gst_asts.png"
     # cut dataset down to gst stars
     # could use ds.select() but i don't like it that much
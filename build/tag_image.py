@@ -20,9 +20,47 @@ Note: Detailed implementation and parameter settings can be found in the script
 
 import wpipe as wp
 from astropy.io import fits
-import time
+import functools
+import multiprocessing
+import os
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from deepCR import deepCR
+import torch
+try:
+    import fitsio
+except ImportError:  # fitsio is optional, fall back to astropy header reads
+    fitsio = None
+
+# dataproduct subtype keyed by the filename suffix (e.g. *_flc.fits -> flc)
+_TYPE_MAP = {
+    "i2d": "DRIZZLED",
+    "drc": "DRIZZLED",
+    "flc": "SCIENCE",
+    "flt": "SCIENCE",
+    "crf": "SCIENCE",
+    "cal": "SCIENCE",
+}
+
+
+def open_header(path, ext=0):
+    """
+    Reads a single FITS header without opening the rest of the file
+
+    Parameters:
+    -----------
+    path : str
+        path to the FITS file.
+    ext : int
+        extension whose header is read, defaults to the primary HDU.
+
+    Returns:
+    --------
+    header: dict-like header of the requested extension.
+    """
+    if fitsio is not None:
+        return fitsio.read_header(path, ext=ext)
+    return fits.getheader(path, ext=ext)
 
 
 def register(task):
@@ -66,73 +104,59 @@ def tag_event_dataproduct(this_event):
     dp_fname = my_procdp.filename
 
     # ! CHANGE NAME OF PROC FILES
-    hdu = fits.open(dp_fname_path)
+    # only primary header keywords are needed, so skip opening the full HDU list
+    hdr = open_header(dp_fname_path)
 
-    FILENAME = hdu[0].header["FILENAME"]
-    TELESCOP = hdu[0].header["TELESCOP"]
-    CAM = hdu[0].header["INSTRUME"]
+    FILENAME = hdr["FILENAME"]
+    TELESCOP = hdr["TELESCOP"]
+    CAM = hdr["INSTRUME"]
 
     if ("JWST" not in TELESCOP):
-        RA = hdu[0].header["RA_TARG"]
-        DEC = hdu[0].header["DEC_TARG"]
-        PA = hdu[0].header["PA_V3"]
-        EXPTIME = hdu[0].header["EXPTIME"]
-        EXPFLAG = hdu[0].header["EXPFLAG"]
-        TARGNAME = hdu[0].header["TARGNAME"]
-        PROPOSALID = hdu[0].header["PROPOSID"]
-        DETECTOR = hdu[0].header["DETECTOR"]
-        CHANNEL = hdu[0].header["DETECTOR"]
+        RA = hdr["RA_TARG"]
+        DEC = hdr["DEC_TARG"]
+        PA = hdr["PA_V3"]
+        EXPTIME = hdr["EXPTIME"]
+        EXPFLAG = hdr["EXPFLAG"]
+        TARGNAME = hdr["TARGNAME"]
+        PROPOSALID = hdr["PROPOSID"]
+        DETECTOR = hdr["DETECTOR"]
+        CHANNEL = hdr["DETECTOR"]
         if ("WFC" in DETECTOR):
-            FILTER1 = hdu[0].header["FILTER1"]
-            FILTER2 = hdu[0].header["FILTER2"]
+            FILTER1 = hdr["FILTER1"]
+            FILTER2 = hdr["FILTER2"]
             if ("CLEAR" not in FILTER1):
                 FILTER = FILTER1
             if ("CLEAR" not in FILTER2):
                 FILTER = FILTER2
         else:
-            FILTER = hdu[0].header["FILTER"]
+            FILTER = hdr["FILTER"]
     else:
-        RA = hdu[0].header["TARG_DEC"]
-        DEC = hdu[0].header["TARG_DEC"]
-        PA = hdu[0].header["GS_V3_PA"]
-        EXPTIME = hdu[0].header["EFFEXPTM"]
+        RA = hdr["TARG_DEC"]
+        DEC = hdr["TARG_DEC"]
+        PA = hdr["GS_V3_PA"]
+        EXPTIME = hdr["EFFEXPTM"]
         EXPFLAG = "MANNORMAL"
-        TARGNAME = hdu[0].header["TARGPROP"]
-        PROPOSALID = hdu[0].header["PROGRAM"]
-        DETECTOR = hdu[0].header["INSTRUME"]
-        CHANNEL = hdu[0].header["CHANNEL"]
-        FILTER = hdu[0].header["FILTER"]
+        TARGNAME = hdr["TARGPROP"]
+        PROPOSALID = hdr["PROGRAM"]
+        DETECTOR = hdr["INSTRUME"]
+        CHANNEL = hdr["CHANNEL"]
+        FILTER = hdr["FILTER"]
 
-    hdu.close()
     dp_fname = dp_fname.rpartition("_")
     dp_fname = f"{dp_fname[0]}_{FILTER}_{dp_fname[2]}"
-    my_job.logprint(f"{dp_fname}")
+    msgs = [f"{dp_fname}"]  # written out in a single log call once tagged
     # proc_dp_fname_path = proc_path + dp_fname  # * new dataproduct path
 
     # ! New dataproduct for proc directory files
     my_procdp.filename = dp_fname  # ! Changes filename
     FILENAME = dp_fname
-    if ("_i2d" in FILENAME):
-        TYPE = "DRIZZLED"
-    if ("_drc" in FILENAME):
-        TYPE = "DRIZZLED"
-    if ("_flc" in FILENAME):
-        TYPE = "SCIENCE"
-    if ("_flt" in FILENAME):
-        TYPE = "SCIENCE"
-    if ("_crf" in FILENAME):
-        TYPE = "SCIENCE"
-    if ("_cal" in FILENAME):
-        TYPE = "SCIENCE"
-    my_procdp = wp.DataProduct(
-        my_config,
-        filename=dp_fname,
-        group="proc",
-        data_type="tagged",
-        subtype=TYPE
-    )
+    suffix = FILENAME.rsplit("_", 1)[-1].split(".")[0]
+    TYPE = _TYPE_MAP.get(suffix, "UNKNOWN")
+    # tag the copied dataproduct in place instead of looking it up again
+    my_procdp.data_type = "tagged"
+    my_procdp.subtype = TYPE
     # my_job.logprint(f"{my_procdp}, {tot_untagged_im}")
-    my_job.logprint(f"{type(my_procdp.dp_id)}, {my_procdp.filename}")
+    msgs.append(f"{type(my_procdp.dp_id)}, {my_procdp.filename}")
 
     # my_job.logprint(f"{this_dp}")
     # my_job.logprint(f"{this_dp.target.datapath}")
@@ -140,39 +164,53 @@ def tag_event_dataproduct(this_event):
 
     # tag_event_dataproduct
     my_procdp_id = my_procdp.dp_id
-    my_procdp = wp.DataProduct(
-        int(my_procdp_id),
-        options={
-            "filename": FILENAME,
-            "ra": RA,
-            "dec": DEC,
-            "telescope": TELESCOP,
-            "detector": DETECTOR,
-            "orientation": PA,
-            "Exptime": EXPTIME,
-            "Expflag": EXPFLAG,
-            "channel": CHANNEL,
-            "cam": CAM,
-            "filter": FILTER,
-            "targname": TARGNAME,
-            "proposalid": PROPOSALID,
-            "type": TYPE,
-            "dp_id": my_procdp_id,
-            "target_id": this_target_id,
-        },
-    )
-    my_job.logprint("Tagged Image Done")
-    my_job.logprint(f"Subtype {my_procdp.subtype}")
-    my_job.logprint(f"Tagged Image options{my_procdp.options}")
+    my_procdp.options = {
+        "filename": FILENAME,
+        "ra": RA,
+        "dec": DEC,
+        "telescope": TELESCOP,
+        "detector": DETECTOR,
+        "orientation": PA,
+        "Exptime": EXPTIME,
+        "Expflag": EXPFLAG,
+        "channel": CHANNEL,
+        "cam": CAM,
+        "filter": FILTER,
+        "targname": TARGNAME,
+        "proposalid": PROPOSALID,
+        "type": TYPE,
+        "dp_id": my_procdp_id,
+        "target_id": this_target_id,
+    }
+    msgs.append("Tagged Image Done")
+    msgs.append(f"Subtype {my_procdp.subtype}")
+    msgs.append(f"Tagged Image options{my_procdp.options}")
+    my_job.logprint("\n".join(msgs))
     return my_procdp
 
 
-def imgclean(imgname, mdl, threshold, update=True):
+def _count_cr(dq):
+    """Counts the pixels with the CR bit (4096) set in a DQ array"""
+    return int(np.count_nonzero(dq & 4096))
+
+
+def _normalize(img):
+    """Standardizes an image to zero mean and unit variance in one float32 buffer"""
+    # FITS data is big-endian, so this always copies; normalize that copy in place
+    out = img.astype(np.float32)
+    out -= out.mean(dtype=np.float32)
+    out *= np.float32(1.0) / out.std(dtype=np.float32)
+    return out
+
+
+def imgclean(imgname, mdl, threshold, update=True, parallel=True, log=None):
     """
     imgname: input image name
     mdl: deepCR model
     threshold: threshold for deepCR
     update: update the original fits file or not
+    parallel: run deepCR on both chips concurrently, set False if the model is not thread-safe
+    log: callable for progress messages, defaults to my_job.logprint
     Three options for CR identification in the pipeline running:
 
     1. regular default pipeline (same as old pipeline):  
@@ -191,80 +229,127 @@ def imgclean(imgname, mdl, threshold, update=True):
     Below is the python function to perform deepCR on each image, and update the DQ cr flag:
 
     """
+    if log is None:
+        log = my_job.logprint
+    # collect the progress messages and write them out in a single log call
+    msgs = []
     # my_job.logprint("\nRunning DeepCR imgclean function")
-    my_job.logprint(
+    msgs.append(
         f"\n image_name: {imgname}, \nthreshold: {threshold}, \nupdate is: {update}")
     # print('image_name:', imgname)
     # print('threshold:', threshold)
     # print('update is', update)
-    # open the image with all extensions
+    # open the image as a memmap, the DQ planes are edited in place so a
+    # flush in update mode writes back only their dirty pages
     if update:
-        imgall = fits.open(imgname, mode='update')
+        imgall = fits.open(imgname, mode='update', memmap=True)
     else:
-        imgall = fits.open(imgname)
+        imgall = fits.open(imgname, memmap=True)
 
     # process each chip/extension of the image, manually normalize the input
-    imgorichip1 = imgall[1].data
-    imgorichip1mean = imgorichip1.mean()
-    imgorichip1std = imgorichip1.std()
-    imgnormchip1 = (imgorichip1 - imgorichip1mean) / imgorichip1std
-    my_job.logprint(f"imgnormchip1: {imgnormchip1.shape}")
-    imgorichip2 = imgall[4].data
-    imgorichip2mean = imgorichip2.mean()
-    imgorichip2std = imgorichip2.std()
-    imgnormchip2 = (imgorichip2 - imgorichip2mean) / imgorichip2std
-    my_job.logprint(f"imgnormchip2: {imgnormchip2.shape}")
-
-    my_job.logprint('----chip1----')
-    my_job.logprint('mdl cleaning')
-    maskimgchip1, cleaned_imgchip1 = mdl.clean(
-        imgnormchip1, threshold=threshold, inpaint='medmask')  # ! crashes computer
-    my_job.logprint('mdl DONE cleaning')
-    maskimgchip1 = np.float32(maskimgchip1)
+    # the SCI data is not needed after normalization, release it before inference
+    imgnormchip1 = _normalize(imgall[1].data)
+    del imgall[1].data
+    msgs.append(f"imgnormchip1: {imgnormchip1.shape}")
+    imgnormchip2 = _normalize(imgall[4].data)
+    del imgall[4].data
+    msgs.append(f"imgnormchip2: {imgnormchip2.shape}")
+
+    # the chips are independent, torch releases the GIL during inference
+    # only the CR mask is used, so skip inpainting and its cleaned image copy
+    msgs.append('mdl cleaning')
+    if parallel:
+        with ThreadPoolExecutor(max_workers=2) as ex:
+            futures = [ex.submit(mdl.clean, imgnorm, threshold=threshold, inpaint=False)
+                       for imgnorm in (imgnormchip1, imgnormchip2)]
+            maskimgchip1, maskimgchip2 = [future.result() for future in futures]
+    else:
+        maskimgchip1 = mdl.clean(
+            imgnormchip1, threshold=threshold, inpaint=False)  # ! crashes computer
+        maskimgchip2 = mdl.clean(
+            imgnormchip2, threshold=threshold, inpaint=False)
+    msgs.append('mdl DONE cleaning')
+
+    msgs.append('----chip1----')
+    maskimgchip1 = np.asarray(maskimgchip1, dtype=np.bool_)
     dqchip1 = imgall[3].data
-    my_job.logprint(
-        f"original MAST DQ: {len(np.where((dqchip1&4096) == 4096)[0])}")
-    # print('original MAST DQ:', len(np.where((dqchip1&4096) == 4096)[0]))
-    dqchip1[dqchip1 & 4096 == 4096] ^= 4096
-    my_job.logprint(
-        f"remove original check: {len(np.where((dqchip1&4096) == 4096)[0])}")
-    # print('remove original check:', len(np.where((dqchip1&4096) == 4096)[0]))
-    dqchip1[maskimgchip1 == 1] |= 4096
-    my_job.logprint(
-        f"after deepCR DQ: {len(np.where((dqchip1&4096) == 4096)[0])}")
-    # print('after deepCR DQ:', len(np.where((dqchip1&4096) == 4096)[0]))
-    imgall[3].data = dqchip1
-    my_job.logprint('CR DQ update done')
-
-    my_job.logprint('\n----chip2----')
-    my_job.logprint('mdl cleaning')
-    maskimgchip2, cleaned_imgchip2 = mdl.clean(
-        imgnormchip2, threshold=threshold, inpaint='medmask')
-    my_job.logprint('mdl DONE cleaning')
-    maskimgchip2 = np.float32(maskimgchip2)
+    before = _count_cr(dqchip1)
+    # clear the CR bit in place
+    np.bitwise_and(dqchip1, ~dqchip1.dtype.type(4096), out=dqchip1)
+    after_clear = _count_cr(dqchip1)
+    # set the CR bit wherever deepCR flagged a cosmic ray
+    cr_bits = maskimgchip1.astype(dqchip1.dtype, copy=False) << 12
+    np.bitwise_or(dqchip1, cr_bits, out=dqchip1)
+    after = _count_cr(dqchip1)
+    msgs.append(f"chip1 CR DQ: original MAST={before}, remove original check={after_clear}, "
+                f"after deepCR={after}")
+    msgs.append('CR DQ update done')
+
+    msgs.append('\n----chip2----')
+    maskimgchip2 = np.asarray(maskimgchip2, dtype=np.bool_)
     dqchip2 = imgall[6].data
-    # # print('original MAST DQ:', len(np.where((dqchip2&4096) == 4096)[0]))
-    my_job.logprint(
-        f'original MAST DQ: {len(np.where((dqchip2&4096) == 4096)[0])}')
-    dqchip2[dqchip2 & 4096 == 4096] ^= 4096
-    # # print('remove original check:', len(np.where((dqchip2&4096) == 4096)[0]))
-    my_job.logprint(
-        f'remove original check: {len(np.where((dqchip2&4096) == 4096)[0])}')
-    dqchip2[maskimgchip2 == 1] |= 4096
-    # # print('after deepCR DQ:', len(np.where((dqchip2&4096) == 4096)[0]))
-    my_job.logprint(
-        f'after deepCR DQ:: {len(np.where((dqchip2&4096) == 4096)[0])}')
-    imgall[6].data = dqchip2
-    my_job.logprint('CR DQ update done')
+    before = _count_cr(dqchip2)
+    # clear the CR bit in place
+    np.bitwise_and(dqchip2, ~dqchip2.dtype.type(4096), out=dqchip2)
+    after_clear = _count_cr(dqchip2)
+    # set the CR bit wherever deepCR flagged a cosmic ray
+    cr_bits = maskimgchip2.astype(dqchip2.dtype, copy=False) << 12
+    np.bitwise_or(dqchip2, cr_bits, out=dqchip2)
+    after = _count_cr(dqchip2)
+    msgs.append(f"chip2 CR DQ: original MAST={before}, remove original check={after_clear}, "
+                f"after deepCR={after}")
+    msgs.append('CR DQ update done')
 
     if update:
         imgall.flush()
-        my_job.logprint('update original fits file done')
+        msgs.append('update original fits file done')
     else:
-        my_job.logprint('original fits file not updated!')
+        msgs.append('original fits file not updated!')
+    imgall.close()
+    log("\n".join(msgs))
     return
 
 
+@functools.lru_cache(maxsize=None)
+def _get_model(deepcr_pth_mask):
+    """Builds the deepCR model once per process and reuses it for every image"""
+    # run inference on the GPU whenever one is visible to this process
+    device = 'GPU' if torch.cuda.is_available() else 'CPU'
+    return deepCR(mask=deepcr_pth_mask, hidden=32, device=device)
+
+
+def _init_deepcr_worker(n_threads):
+    """Limits torch in a worker process to its share of the job's cores"""
+    torch.set_num_threads(n_threads)
+
+
+def _deepcr_worker(imgname, deepcr_pth_mask, threshold, parallel):
+    """
+    Runs imgclean on a single image inside a worker process
+
+    Parameters:
+    -----------
+    imgname : str
+        path to the flc.fits image to clean.
+    deepcr_pth_mask : str
+        path to the trained deepCR mask model.
+    threshold : float
+        threshold for deepCR.
+    parallel : bool
+        clean both chips of the image concurrently.
+
+    Returns:
+    --------
+    imgname: the path of the cleaned image.
+    report: the imgclean log messages, for the parent to write to the job log.
+    """
+    mdl = _get_model(deepcr_pth_mask)
+    # the job log is owned by the parent, hand the messages back to it
+    msgs = []
+    imgclean(imgname, mdl, threshold, update=True, parallel=parallel, log=msgs.append)
+    return imgname, "\n".join(msgs)
+
+
 if __name__ == "__main__":
     my_pipe = wp.Pipeline()
     my_job = wp.Job()
@@ -290,6 +375,10 @@ if __name__ == "__main__":
         f"\n parameter atrributs: {dir(my_job.config.parameters)}")
     my_job.logprint(
         f"\nRUN_DEEPCR setting: {my_job.config.parameters['RUN_DEEPCR']}, {type(my_job.config.parameters['RUN_DEEPCR'])}")
+    try:
+        deepcr_parallel = my_config_param["deepcr_parallel"] == 'T'
+    except Exception:
+        deepcr_parallel = True
     if "UVIS" in my_dp.options["detector"]:
         if my_config_param['RUN_DEEPCR'] == 'T' and my_config_param['machine'] == 'remote':
             my_job.logprint("Running DeepCR REMOTELY)")
@@ -297,7 +386,7 @@ if __name__ == "__main__":
             #! DeepCR parameters from config file
             deepcr_pth_mask = my_config_param["deepcr_pth"]
             threshold = my_config_param["deepcr_threshold"]
-            mdl = deepCR(mask=deepcr_pth_mask, hidden=32)
+            mdl = _get_model(deepcr_pth_mask)
             # file path to image being tagged currently
             procdp_path = my_config.procpath + "/"
             my_job.logprint(f"\n {my_dp}, {type(my_dp)}, {procdp_path}")
@@ -307,7 +396,8 @@ if __name__ == "__main__":
 
             # * imgclean function
             # Run DeepCR on each image
-            imgclean(dp_filepath, mdl, threshold, update=True)
+            imgclean(dp_filepath, mdl, threshold, update=True,
+                     parallel=deepcr_parallel)
 
     elif my_config_param['RUN_DEEPCR'] == 'F':
         my_job.logprint(f"Not running DeepCR")
@@ -341,38 +431,29 @@ if __name__ == "__main__":
             dpowner_id=my_config.config_id, data_type="tagged"
         )  # Get dataproducts associated with configuration (ie. dps for my_target)
 
-        filters = []  # Making list of filters for target
-        jwfilters = []
-        adrizfilters = []
+        # Making sets of the different filters for target
+        all_filters = set()
+        jwfilters = set()
+        adriz_filters = set()
+        flc_paths = []  # images to run DeepCR on locally
+        # every tagged dp belongs to this configuration, so they share its proc path
+        procdp_path = my_config.procpath + "/"  # file path to image
         my_job.logprint(
             "All Dataproducts that are done being tagged and ready for DeepCR task!")
         for dp in my_dp:
-            my_job.logprint(f"\n{dp.filename}, {dp.options['filter']}")
-            filters.append(dp.options["filter"])
+            filt = dp.options["filter"]
+            my_job.logprint(f"\n{dp.filename}, {filt}")
+            all_filters.add(filt)
             if dp.options["telescope"] == "JWST":
-                jwfilters.append(dp.options["filter"])
+                jwfilters.add(filt)
             else:
-                adrizfilters.append(dp.options["filter"])
+                adriz_filters.add(filt)
                 if my_config_param['RUN_DEEPCR'] == 'T' and my_config_param['machine'] == 'local':
-                    my_job.logprint("Running DeepCR LOCALLY")
-                    #! #########################################
-                    #! DeepCR parameters from config file
-                    deepcr_pth_mask = my_config_param["deepcr_pth"]
-                    threshold = my_config_param["deepcr_threshold"]
-                    mdl = deepCR(mask=deepcr_pth_mask, hidden=32)
-
-                    #! Run DeepCR on each dataproducts
-                    procdp_path = dp.config.procpath + "/"  # file path to image
+                    #! Collect images to run DeepCR on
                     # my_job.logprint(f"\n {dp}, {type(dp)}, {procdp_path}")
 
                     if dp.filename.split("_")[-1] == "flc.fits":
-                        ext_flc = dp.filename.split("_")[-1]
-                        # my_job.logprint(ext_flc)
-
-                        dp_filepath = procdp_path + "/" + dp.filename
-                        my_job.logprint(
-                            f"Running imgclean on {dp.filename}...")
-                        imgclean(dp_filepath, mdl, threshold, update=True)
+                        flc_paths.append(procdp_path + "/" + dp.filename)
 
                 elif my_config_param['RUN_DEEPCR'] == 'F':
                     my_job.logprint(f"Not running DeepCR")
@@ -388,12 +469,43 @@ if __name__ == "__main__":
                         f"RUN_DEEPCR parameter not set... Not running DeepCR.")
                     # tag = str(update_option),
 
-        all_filters = set(
-            filters
-        )  # Remove duplicates to get array of different filters for target
-        adriz_filters = set(
-            adrizfilters
-        )  # Remove duplicates to get array of different filters for target
+        if len(flc_paths) > 0:
+            my_job.logprint("Running DeepCR LOCALLY")
+            #! #########################################
+            #! DeepCR parameters from config file
+            deepcr_pth_mask = my_config_param["deepcr_pth"]
+            threshold = my_config_param["deepcr_threshold"]
+            #! Run DeepCR on a few images at a time, each worker loads the model once
+            n_img = len(flc_paths)
+            try:
+                n_workers = int(my_config_param["deepcr_workers"])
+            except Exception:
+                n_workers = 2
+            if torch.cuda.is_available():
+                # a single CUDA context, workers would share the one device
+                n_workers = 1
+            # respect the cores allocated to this job, not the whole node
+            if hasattr(os, "sched_getaffinity"):
+                n_cores = len(os.sched_getaffinity(0))
+            else:
+                n_cores = os.cpu_count() or 1
+            n_workers = max(1, min(n_img, n_workers, n_cores))
+            # split the cores between workers, and between the two chip threads
+            # of each worker, so torch does not oversubscribe them
+            n_threads = max(1, n_cores // (n_workers * (2 if deepcr_parallel else 1)))
+            my_job.logprint(
+                f"Running imgclean on {n_img} images with {n_workers} workers x {n_threads} threads...")
+            # spawn the workers, the CUDA check above may have initialized the
+            # driver in this process and a forked child cannot use it
+            with ProcessPoolExecutor(max_workers=n_workers,
+                                     mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=_init_deepcr_worker,
+                                     initargs=(n_threads,)) as ex:
+                for dp_filepath, report in ex.map(_deepcr_worker, flc_paths,
+                                                  [deepcr_pth_mask] * n_img,
+                                                  [threshold] * n_img,
+                                                  [deepcr_parallel] * n_img):
+                    my_job.logprint(f"{report}\nimgclean done on {dp_filepath}")
 
         my_config.parameters["filters"] = ",".join(
             all_filters
@@ -444,8 +556,6 @@ if __name__ == "__main__":
             )  # next event
             next_event.fire()
 
-        time.sleep(150)
-
         # my_job.logprint(f"Firing Event Options: {my_event.options}")
 
     else: